@@ -1,4 +1,5 @@
 import bw2data as bd
+from bw2data.parameters import ActivityParameter
 import warnings
 from .utils import ParameterNameGenerator
 from presamples.models.parameterized import ParameterizedBrightwayModel as PBM
@@ -33,7 +34,7 @@ class ActivityLandBalancer:
             setattr(self, keys, getattr(database_land_balancer, keys))
         land_exchanges = [
             exc for exc in self.act.exchanges()
-            if exc.input.key in self.all_land_keys
+            if self._input_key(exc) in self.all_land_keys
         ]
         if not land_exchanges:
             self.strategy = "skip"
@@ -42,9 +43,9 @@ class ActivityLandBalancer:
             self._move_exchange_formulas_to_temp()
             self.land_exchanges = [
                 exc for exc in self.act.exchanges()
-                if exc.input.key in self.all_land_keys
+                if self._input_key(exc) in self.all_land_keys
             ]
-            self.land_exchange_input_keys = [exc.input.key for exc in self.land_exchanges]
+            self.land_exchange_input_keys = [self._input_key(exc) for exc in self.land_exchanges]
             self.land_exchange_types = [self._get_type(exc) for exc in self.land_exchanges]
             namer = ParameterNameGenerator()
             self.land_exchange_param_names = [namer['land_param'] for _ in range(len(self.land_exchanges))]
@@ -70,16 +71,16 @@ class ActivityLandBalancer:
         self._move_activity_parameters_to_temp()
         bd.parameters.new_activity_parameters(self.activity_params, self.group)
         bd.parameters.add_exchanges_to_group(self.group, self.act)
-        bd.parameters.recalculate()
+        # Only the balancing group needs to be fresh, no need to recalculate all groups
+        ActivityParameter.recalculate(self.group)
         pbm = PBM(self.group)
         pbm.load_parameter_data()
         pbm.calculate_stochastic(iterations, update_amounts=True)
         pbm.calculate_matrix_presamples()
         self.matrix_data = pbm.matrix_data
+        # This adds activity parameters that are actually not wanted. They are
+        # overwritten when restoring the activity parameters below.
         bd.parameters.remove_from_group(self.group, self.act)
-        # This adds activity parameters that are actually not wanted. Remove them.
-        self.act['parameters'] = []
-        self.act.save()
         self.activity_params = []
         self._restore_activity_parameters()
         self._restore_exchange_formulas()
@@ -96,6 +97,11 @@ class ActivityLandBalancer:
             exc for i, exc in enumerate(self.land_exchanges)
             if self.land_exchange_types[i] == 'land_in'
         ]
+        self.strategy = self._get_strategy(land_in, land_out)
+
+    @staticmethod
+    def _get_strategy(land_in, land_out):
+        """Return strategy to use given land input and land output exchanges"""
 
         # Identify non-zero exchanges
         non_zero_in = [exc for exc in land_in if exc['amount'] != 0]
@@ -104,8 +110,7 @@ class ActivityLandBalancer:
         # If there isn't at least one non-zero input land exchange and one non-zero
         # output land exchange, skip
         if any([not non_zero_in, not non_zero_out]):
-            self.strategy = "skip"
-            return
+            return "skip"
 
         # Identify land exchanges with uncertainty
         exc_with_uncertainty_inputs = [exc for exc in land_in if exc.get('uncertainty type', 0) != 0]
@@ -113,16 +118,44 @@ class ActivityLandBalancer:
 
         # If there aren't any uncertain land exchanges, skip
         if len(exc_with_uncertainty_inputs + exc_with_uncertainty_outputs) == 0:
-            self.strategy = "skip"
+            return "skip"
         # If there is only one uncertain land exchange, set_static
         elif len(exc_with_uncertainty_inputs + exc_with_uncertainty_outputs) == 1:
-            self.strategy = "set_static"
+            return "set_static"
         # If there are no uncertain inputs, inverse strategy (i.e. rescale outputs)
         elif len(exc_with_uncertainty_inputs) == 0:
-            self.strategy = "inverse"
+            return "inverse"
         # Apply default strategy otherwise (i.e. rescale inputs)
         else:
-            self.strategy = "default"
+            return "default"
+
+    @classmethod
+    def count_sample_rows(cls, act_key, database_land_balancer):
+        """Return the number of sample rows `generate_samples` yields for an activity
+
+        Unlike instantiation, this does not modify the activity or its exchanges,
+        and can therefore be used to size sample arrays before generating samples.
+
+        Parameters:
+        ------------
+           act_key: tuple
+               Key of the activity.
+           database_land_balancer: DatabaseLandBalancer
+               Instance of a DatabaseLandBalancer
+        """
+        land_in, land_out = [], []
+        for exc in bd.get_activity(act_key).exchanges():
+            input_key = cls._input_key(exc)
+            if input_key in database_land_balancer.land_in_keys:
+                land_in.append(exc)
+            elif input_key in database_land_balancer.land_out_keys:
+                land_out.append(exc)
+        strategy = cls._get_strategy(land_in, land_out)
+        if strategy == 'skip':
+            return 0
+        if strategy == 'set_static':
+            return 1
+        return len(land_in) + len(land_out)
 
     def _define_balancing_parameters(self):
         """Define activity-level and exchange-level parameters for rebalancing
@@ -309,7 +342,7 @@ class ActivityLandBalancer:
         """
         excs = [
             exc for exc in self.act.exchanges()
-            if exc.input.key in self.all_land_keys and exc.get('uncertainty type', 0) != 0
+            if self._input_key(exc) in self.all_land_keys and exc.get('uncertainty type', 0) != 0
         ]
         if len(excs) != 1:
             raise ValueError("Should only have one variable land exchange for 'set_static' strategy")
@@ -358,9 +391,14 @@ class ActivityLandBalancer:
         else:
             return "({})".format(" + ".join(terms))
 
+    @staticmethod
+    def _input_key(exc):
+        """Return key of exchange input without loading the input activity"""
+        return tuple(exc['input'])
+
     def _get_type(self, exc):
         """Return type of exchange"""
-        input_key = exc.input.key
+        input_key = self._input_key(exc)
         if input_key in self.land_in_keys:
             return 'land_in'
         elif input_key in self.land_out_keys:
@@ -447,6 +485,8 @@ class ActivityLandBalancer:
         Should be done once done working with the activity.
         """
         for exc in self.act.exchanges():
+            if 'formula' not in exc and 'temp_formula' not in exc:
+                continue
             if 'formula' in exc:
                 exc['land_formula'] = copy.copy(exc.get('formula', None))
                 del exc['formula']
@@ -1,11 +1,26 @@
 import bw2data as bd
+from bw2data.backends.peewee import ActivityDataset, ExchangeDataset
+import multiprocessing
 import numpy as np
+import os
+import types
+import uuid
 import warnings
 import pyprind
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import accumulate
 from .activity_land_balancer import ActivityLandBalancer
+from .utils import match_any
 from presamples import create_presamples_package, split_inventory_presamples
 
 
+# Matrix indices are (input key, output key, exchange type), keys being tuples
+INDICES_DTYPE = [('input', 'O'), ('output', 'O'), ('type', 'O')]
+# Type of biosphere exchanges, and label of biosphere matrix data in presamples
+_BIOSPHERE = 'biosphere'
+
+
 class DatabaseLandBalancer:
     """Used to create balanced land samples to override unbalanced sample
 
@@ -39,16 +54,25 @@ class DatabaseLandBalancer:
            List of string patterns identifying land states prior to transformation
        land_to_patterns: list of strings, default ['Transformation, to']
            List of string patterns identifying land states after transformation
+       scratch_dir: string, optional
+           Directory in which samples generated by `add_samples_for_acts`
+           are stored in a memory-mapped file rather than held in memory.
+           Files are not deleted automatically.
+       dtype: numpy dtype, default numpy.float32
+           Data type of stored samples. Single precision (relative precision
+           of about 1e-7) halves memory use and the size of presamples packages,
+           and is well below the uncertainty of sampled land exchanges. Use
+           numpy.float64 to keep samples in double precision.
 
     Attributes:
     -----------
-       all_land_keys: list
-           List of all keys of land elementary flows
-       land_in_keys: list
-           List of all keys of elementary flows associated with land states prior
+       all_land_keys: frozenset
+           Set of all keys of land elementary flows
+       land_in_keys: frozenset
+           Set of all keys of elementary flows associated with land states prior
            to transformation
-       land_out_keys: list
-           List of all keys of elementary flows associated with land states after
+       land_out_keys: frozenset
+           Set of all keys of elementary flows associated with land states after
             transformation
        database_name: string
            Name of the LCI database in the brightway2 project
@@ -56,11 +80,17 @@ class DatabaseLandBalancer:
            Name of the biosphere database in the brighway2 database
        group: string, default='land'
            Name of the parameter group name. Used in the generation of samples.
-       matrix_indices: list
-           List of numpy structured arrays containing the matrix indices associated
-           with samples
-       matrix_samples: list
-           List of numpy arrays with samples
+       matrix_indices: numpy structured array or None
+           Array with the (input, output, type) matrix indices associated
+           with samples, of dtype `INDICES_DTYPE`
+       matrix_samples: numpy array or None
+           Array of samples, one row per element of `matrix_indices`. Memory-mapped
+           if `scratch_dir` is set and samples were added with a single call to
+           `add_samples_for_acts` or `add_samples_for_all_acts`
+       scratch_dir: string or None
+           Directory for memory-mapped sample files
+       dtype: numpy dtype
+           Data type of stored samples
     """
     def __init__(
         self,
@@ -69,6 +99,8 @@ class DatabaseLandBalancer:
         group="land",
         land_from_patterns=('Transformation, from', ),
         land_to_patterns=('Transformation, to', ),
+        scratch_dir=None,
+        dtype=np.float32,
     ):
 
         # Check that the database exists in the current project
@@ -80,22 +112,22 @@ class DatabaseLandBalancer:
             raise ValueError("Database {} not imported".format(biosphere))
         self.biosphere = biosphere
         self.group = group
-        self.matrix_indices = []
-        self.matrix_samples = None
+        self.scratch_dir = scratch_dir
+        self.dtype = dtype
+        self._indices_chunks = []
+        self._samples_chunks = []
 
         print("Getting information on land transformation exchanges")
-        self.land_in_keys = []
-        for ef in bd.Database(self.biosphere):
-            for land_from_pattern in land_from_patterns:
-                if land_from_pattern in ef['name']:
-                    self.land_in_keys.append(ef.key)
-        self.land_out_keys = []
-        for ef in bd.Database(self.biosphere):
-            for land_to_pattern in land_to_patterns:
-                if land_to_pattern in ef['name']:
-                    self.land_out_keys.append(ef.key)
-
-        self.all_land_keys = self.land_in_keys + self.land_out_keys
+        names, keys = _load_biosphere_flows(
+            bd.projects.dir, self.biosphere, bd.databases[self.biosphere].get('modified')
+        )
+        land_in_mask = match_any(names, land_from_patterns)
+        land_out_mask = match_any(names, land_to_patterns) & ~land_in_mask
+
+        # Sets, as they are used for membership tests for every exchange
+        self.land_in_keys = frozenset(keys[land_in_mask].tolist())
+        self.land_out_keys = frozenset(keys[land_out_mask].tolist())
+        self.all_land_keys = self.land_in_keys | self.land_out_keys
 
     def add_samples_for_act(self, act_key, iterations):
         """Add samples and indices for given activity
@@ -114,31 +146,193 @@ class DatabaseLandBalancer:
         """
         ab = ActivityLandBalancer(act_key, self)
         for data in ab.generate_samples(iterations):
-            if len(data[1][0]) == 2:
-                for row in data[1]:
-                    self.matrix_indices.append((row[0], row[1], 'biosphere'))
-            else:
-                self.matrix_indices.extend(data[1])
-            if self.matrix_samples is None:
-                self.matrix_samples = data[0]
-            else:
-                self.matrix_samples = np.concatenate([self.matrix_samples, data[0]], axis=0)
-
-    def add_samples_for_all_acts(self, iterations):
+            self._indices_chunks.append(self._format_matrix_indices(data[1], data[2]))
+            self._samples_chunks.append(data[0].astype(self.dtype, copy=False))
+
+    @property
+    def matrix_indices(self):
+        """Structured array of matrix indices, one element per row of `matrix_samples`
+
+        Returns None if no samples were added.
+        """
+        if not self._indices_chunks:
+            return None
+        if len(self._indices_chunks) > 1:
+            self._indices_chunks = [np.concatenate(self._indices_chunks)]
+        return self._indices_chunks[0]
+
+    @property
+    def matrix_samples(self):
+        """Array of samples, with rows ordered as in `matrix_indices`
+
+        Samples are collected in chunks and only concatenated on access, so
+        that adding samples for many activities does not repeatedly copy all
+        previously added samples. Returns None if no samples were added.
+        """
+        if not self._samples_chunks:
+            return None
+        if len(self._samples_chunks) > 1:
+            self._samples_chunks = [np.concatenate(self._samples_chunks, axis=0)]
+        return self._samples_chunks[0]
+
+    def add_samples_for_all_acts(self, iterations, max_workers=None):
         """Add samples and indices for all activities in database
 
-        Iterates through all activities in database and calls activity-
-        level method add_samples_for_act
+        Only activities of the database that have land exchanges are passed
+        to `add_samples_for_acts`. Other activities would not yield samples
+        and are not loaded at all.
 
         Parameters:
         -----------
            iterations: int
                Number of iterations in generated samples
+           max_workers: int, optional
+               If larger than 1, samples are generated in this many worker
+               processes, each working on a temporary copy of the current
+               project. Default is to generate samples in the current process.
+
+        """
+        self.add_samples_for_acts(self._get_acts_with_land_exchanges(), iterations, max_workers)
+
+    def add_samples_for_acts(self, act_keys, iterations, max_workers=None):
+        """Add samples and indices for a batch of activities
+
+        Generates samples for each activity with an `ActivityLandBalancer`.
+        The number of sample rows of each activity is determined beforehand,
+        so that samples for the whole batch are written in a single
+        preallocated array. Activities that yield no samples are skipped.
+        All samples added end up in the same presamples package when calling
+        `create_presamples`.
+
+        Parameters:
+        -----------
+           act_keys: list of tuples
+               Keys of target activities in database
+           iterations: int
+               Number of iterations in generated samples
+           max_workers: int, optional
+               If larger than 1, samples are generated in this many worker
+               processes, each working on a temporary copy of the current
+               project. Default is to generate samples in the current process.
+
+        """
+        act_keys = list(act_keys)
+        rows_per_act = self._count_rows_per_activity(act_keys)
+        to_sample = [
+            (act_key, offset, n)
+            for act_key, offset, n in zip(act_keys, accumulate([0] + rows_per_act), rows_per_act)
+            if n
+        ]
+        if not to_sample:
+            return
+        n_rows = sum(rows_per_act)
+        samples = self._allocate_samples(n_rows, iterations)
+        indices = np.empty(n_rows, dtype=INDICES_DTYPE)
+        if max_workers is None or max_workers <= 1:
+            for act_key, offset, n in pyprind.prog_bar(to_sample):
+                matrix_data = ActivityLandBalancer(act_key, self).generate_samples(iterations)
+                self._write_matrix_data(act_key, matrix_data, samples, indices, offset, n)
+        else:
+            self._add_samples_in_parallel(to_sample, iterations, samples, indices, max_workers)
+        self._samples_chunks.append(samples)
+        self._indices_chunks.append(indices)
+
+    def _add_samples_in_parallel(self, to_sample, iterations, samples, indices, max_workers):
+        """Generate samples for (act_key, offset, n_rows) in worker processes
+
+        Brightway sqlite databases do not support concurrent writes, and
+        generating samples writes parameters and formulas. Each worker
+        therefore works on its own temporary copy of the current project.
+        Copies are deleted once all samples are generated.
+        """
+        worker_projects = [
+            "{}_land_balancer_{}".format(bd.projects.current, uuid.uuid4().hex)
+            for _ in range(max_workers)
+        ]
+        project_queue = multiprocessing.Queue()
+        try:
+            for project_name in worker_projects:
+                bd.projects.copy_project(project_name, switch=False)
+                project_queue.put(project_name)
+            progress = pyprind.ProgBar(len(to_sample))
+            with ProcessPoolExecutor(
+                    max_workers=max_workers,
+                    initializer=_init_worker,
+                    initargs=(project_queue,)
+            ) as executor:
+                futures = {
+                    executor.submit(
+                        _generate_samples_for_act, act_key, iterations,
+                        self.land_in_keys, self.land_out_keys, self.group
+                    ): (act_key, offset, n)
+                    for act_key, offset, n in to_sample
+                }
+                for future in as_completed(futures):
+                    act_key, offset, n = futures[future]
+                    self._write_matrix_data(act_key, future.result(), samples, indices, offset, n)
+                    progress.update()
+        finally:
+            for project_name in worker_projects:
+                if project_name in bd.projects:
+                    bd.projects.delete_project(project_name, delete_dir=True)
+
+    def _allocate_samples(self, n_rows, iterations):
+        """Return an uninitialized array for samples, memory-mapped if `scratch_dir` is set"""
+        if self.scratch_dir is None:
+            return np.empty((n_rows, iterations), dtype=self.dtype)
+        return np.memmap(
+            os.path.join(self.scratch_dir, "land_samples_{}.dat".format(uuid.uuid4().hex)),
+            dtype=self.dtype, mode='w+', shape=(n_rows, iterations)
+        )
+
+    def _get_acts_with_land_exchanges(self):
+        """Return keys of activities in database with at least one land exchange"""
+        land_codes = [code for database, code in self.all_land_keys if database == self.biosphere]
+        return list(
+            ExchangeDataset.select(ExchangeDataset.output_database, ExchangeDataset.output_code)
+            .where(
+                ExchangeDataset.output_database == self.database_name,
+                ExchangeDataset.input_database == self.biosphere,
+                ExchangeDataset.input_code << land_codes,
+            )
+            .order_by(ExchangeDataset.output_code)
+            .distinct()
+            .tuples()
+        )
+
+    def _count_rows_per_activity(self, act_keys):
+        """Return list with the number of sample rows for each activity"""
+        return [ActivityLandBalancer.count_sample_rows(act_key, self) for act_key in act_keys]
+
+    def _write_matrix_data(self, act_key, matrix_data, samples, indices, offset, n_rows):
+        """Write matrix data of activity to `samples` and `indices` starting at row `offset`"""
+        end = offset
+        for data in matrix_data:
+            rows = data[0].shape[0]
+            samples[end:end + rows] = data[0]
+            indices[end:end + rows] = self._format_matrix_indices(data[1], data[2])
+            end += rows
+        if end - offset != n_rows:
+            raise ValueError(
+                "Expected {} sample rows for activity {}, got {}".format(
+                    n_rows, act_key, end - offset
+                )
+            )
+
+    @staticmethod
+    def _format_matrix_indices(indices, label):
+        """Return matrix indices as structured array of dtype `INDICES_DTYPE`
 
+        `indices` and `label` are as returned by `split_inventory_presamples`:
+        biosphere indices only have input and output keys, other indices
+        already include the exchange type.
         """
-        act_keys = [act.key for act in bd.Database(self.database_name)]
-        for act_key in pyprind.prog_bar(act_keys):
-            self.add_samples_for_act(bd.get_activity(act_key), iterations)
+        if label != _BIOSPHERE:
+            return np.array(indices, dtype=INDICES_DTYPE)
+        array = np.empty(len(indices), dtype=INDICES_DTYPE)
+        array[['input', 'output']] = indices
+        array['type'] = _BIOSPHERE
+        return array
 
     def create_presamples(self, name=None, id_=None, overwrite=False, dirpath=None, seed='sequential'):
         """Create a presamples package from generated samples
@@ -157,7 +351,7 @@ class DatabaseLandBalancer:
            seed: {None, int, "sequential"}, optional, default="sequential"
                Seed used by indexer to return array columns in random order. Can be an integer, "sequential" or None.
         """
-        if not all([self.matrix_samples is not None, self.matrix_indices]):
+        if self.matrix_samples is None or self.matrix_indices is None:
             warnings.warn(
                 "No presamples created because there were no matrix data. "
                 "Make sure to run `add_samples_for_all_acts` or "
@@ -165,8 +359,53 @@ class DatabaseLandBalancer:
             )
             return
 
+        # presamples slices each index row, which numpy records do not support,
+        # so indices are only converted to a list of tuples here
         id_, dirpath = create_presamples_package(
-            matrix_data=split_inventory_presamples(self.matrix_samples, self.matrix_indices),
+            matrix_data=split_inventory_presamples(self.matrix_samples, self.matrix_indices.tolist()),
             name=name, id_=id_, overwrite=overwrite, dirpath=dirpath, seed=seed)
         print("Presamples with id_ {} written at {}".format(id_, dirpath))
         return id_, dirpath
+
+
+@lru_cache(maxsize=8)
+def _load_biosphere_flows(project_dir, biosphere, modified):
+    """Return read-only arrays of names and keys of flows in biosphere database
+
+    Cached, so that instantiating several `DatabaseLandBalancer` for the same
+    biosphere only loads its flows once. `project_dir` and `modified` are
+    only part of the cache key: they make sure flows are reloaded when the
+    project changes or the biosphere database is modified.
+    """
+    # Only load names and keys, not complete activities
+    biosphere_flows = list(
+        ActivityDataset.select(
+            ActivityDataset.name, ActivityDataset.database, ActivityDataset.code
+        ).where(ActivityDataset.database == biosphere).tuples()
+    )
+    names = np.array([name for name, _, _ in biosphere_flows], dtype=str)
+    keys = np.empty(len(biosphere_flows), dtype=object)
+    for i, (_, database, code) in enumerate(biosphere_flows):
+        keys[i] = (database, code)
+    names.setflags(write=False)
+    keys.setflags(write=False)
+    return names, keys
+
+
+def _init_worker(project_queue):
+    """Switch worker process to a project copy not used by other workers"""
+    bd.projects.set_current(project_queue.get())
+
+
+def _generate_samples_for_act(act_key, iterations, land_in_keys, land_out_keys, group):
+    """Generate samples for activity in a worker process
+
+    Only the state needed by `ActivityLandBalancer` is passed to workers.
+    """
+    state = types.SimpleNamespace(
+        land_in_keys=land_in_keys,
+        land_out_keys=land_out_keys,
+        all_land_keys=land_in_keys | land_out_keys,
+        group=group,
+    )
+    return ActivityLandBalancer(act_key, state).generate_samples(iterations)
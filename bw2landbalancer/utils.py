@@ -1,5 +1,6 @@
 import collections
 import itertools
+import numpy as np
 
 
 class ParameterNameGenerator(object):
@@ -11,3 +12,14 @@ class ParameterNameGenerator(object):
         """Returns a k:v in d equal to key:the number of times that key has come up.
            Used for creating parameter names"""
         return "{}_{}".format(key, next(self.d[key]))
+
+
+def match_any(strings, patterns):
+    """Return boolean mask of elements of `strings` containing any of `patterns`
+
+    `strings` is a numpy string array, searched with one vectorized scan per
+    pattern."""
+    mask = np.zeros(len(strings), dtype=bool)
+    for pattern in patterns:
+        mask |= np.char.find(strings, pattern) >= 0
+    return mask
@@ -100,7 +100,7 @@ def test_reset(data_for_testing):
 def test_rebalance_default_ratio_1(data_for_testing):
     """ """
     wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
-    assert wb.matrix_indices == []
+    assert wb.matrix_indices is None
     assert wb.matrix_samples is None
     ab = ActivityLandBalancer(('test_db', 'A'), wb)
     ab._identify_strategy()
@@ -271,7 +271,7 @@ def test_rebalance_skip_no_uncertainty(data_for_testing):
 def test_all_matrix_data_and_presamples(data_for_testing):
     """ """
     wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
-    assert wb.matrix_indices == []
+    assert wb.matrix_indices is None
     assert wb.matrix_samples is None
     wb.add_samples_for_all_acts(5)
     assert len(wb.matrix_indices) == 18
@@ -281,3 +281,89 @@ def test_all_matrix_data_and_presamples(data_for_testing):
     samples_0 = np.load(dirpath/"{}.0.samples.npy".format(id_))
     assert indices_0.shape[0] == 18
     assert samples_0.shape[1] == 5
+
+
+def test_count_sample_rows(data_for_testing):
+    """ Rows are counted without modifying exchanges"""
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+    assert ActivityLandBalancer.count_sample_rows(('test_db', 'A'), wb) == 4
+    assert ActivityLandBalancer.count_sample_rows(('test_db', 'H'), wb) == 1
+    assert ActivityLandBalancer.count_sample_rows(('test_db', 'I'), wb) == 0
+    act = bd.get_activity(("test_db", "A"))
+    exc = [exc for exc in act.exchanges() if exc.input.key == ('biosphere', 'Transformation, from 1')][0]
+    assert exc['formula'] == 'some_formula'
+
+
+def test_all_matrix_data_parallel(data_for_testing):
+    """ Samples generated in worker processes end up at the right rows"""
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(5, max_workers=2)
+    assert len(wb.matrix_indices) == 18
+    assert wb.matrix_samples.shape == (18, 5)
+    set_static_row = wb.matrix_indices.tolist().index(
+        (("biosphere", "Transformation, to 1"), ('test_db', 'H'), 'biosphere')
+    )
+    assert np.allclose(wb.matrix_samples[set_static_row], 1)
+    assert bd.projects.current == 'default'
+    assert len(bd.projects) == 1
+
+
+def test_all_matrix_data_memmap(data_for_testing, tmp_path):
+    """ Samples are written to a memory-mapped file in scratch_dir"""
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", scratch_dir=str(tmp_path))
+    wb.add_samples_for_all_acts(5)
+    assert isinstance(wb.matrix_samples, np.memmap)
+    assert wb.matrix_samples.shape == (18, 5)
+    assert len(list(tmp_path.iterdir())) == 1
+    id_, dirpath = wb.create_presamples(id_="test")
+    samples_0 = np.load(dirpath/"{}.0.samples.npy".format(id_))
+    assert samples_0.shape == (18, 5)
+
+
+def test_samples_dtype(data_for_testing):
+    """ Samples are stored with the requested dtype"""
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_all_acts(5)
+    assert wb.matrix_samples.dtype == np.float32
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere", dtype=np.float64)
+    wb.add_samples_for_act(('test_db', 'A'), 5)
+    assert wb.matrix_samples.dtype == np.float64
+
+
+def test_acts_with_land_exchanges(data_for_testing):
+    """ Only activities with land exchanges are considered"""
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+    act_keys = wb._get_acts_with_land_exchanges()
+    assert ('test_db', 'X') not in act_keys
+    assert ('test_db', 'A') in act_keys
+    assert len(act_keys) == len(set(act_keys))
+
+
+def test_no_presamples_without_samples(data_for_testing):
+    """ Nothing written if no samples were added"""
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+    with pytest.warns(UserWarning, match="No presamples created"):
+        assert wb.create_presamples() is None
+
+
+def test_batch_matrix_data_and_presamples(data_for_testing):
+    """ Samples for a batch of activities go in one array and package"""
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+    wb.add_samples_for_acts([('test_db', 'A'), ('test_db', 'I'), ('test_db', 'H')], 5)
+    assert wb.matrix_samples.shape == (5, 5)
+    assert len(wb.matrix_indices) == 5
+    assert set(wb.matrix_indices['output']) == {('test_db', 'A'), ('test_db', 'H')}
+    id_, dirpath = wb.create_presamples(id_="test")
+    indices_0 = np.load(dirpath/"{}.0.indices.npy".format(id_))
+    assert indices_0.shape[0] == 5
+
+
+def test_biosphere_flows_reloaded_when_modified(data_for_testing):
+    """ Cached biosphere flows are not used once the biosphere changes"""
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+    assert len(wb.land_in_keys) == 2
+    bd.Database("biosphere").new_activity(
+        "Transformation, from 3", name="Transformation, from 3", unit="square meter"
+    ).save()
+    wb = DatabaseLandBalancer(database_name="test_db", biosphere="biosphere")
+    assert ("biosphere", "Transformation, from 3") in wb.land_in_keys